@@ -1,64 +1,229 @@
 import pysam
-import json
+import orjson
+import os
 import argparse
+import numpy as np
+from collections import defaultdict
 
 
-def extract_pileup_data(bam_file, vcf_file, output_json, flanking_bp=200):
-    # Open BAM file
-    bam = pysam.AlignmentFile(bam_file, "rb")
+def merge_windows(positions, flanking_bp):
+    """Merge sorted variant positions into maximal non-overlapping fetch intervals.
 
-    # Read variants from VCF file
-    variants = []
+    Returns a list of (start, end, first_idx, last_idx) where positions[first_idx:last_idx]
+    fall into the merged interval.
+    """
+    intervals = []
+    first = 0
+    start = max(0, positions[0] - flanking_bp)
+    end = positions[0] + flanking_bp
+    for i in range(1, len(positions)):
+        win_start = max(0, positions[i] - flanking_bp)
+        if win_start <= end:
+            end = max(end, positions[i] + flanking_bp)
+        else:
+            intervals.append((start, end, first, i))
+            first = i
+            start, end = win_start, positions[i] + flanking_bp
+    intervals.append((start, end, first, len(positions)))
+    return intervals
+
+
+def iter_pileup_records(bam, variants_by_chrom, flanking_bp):
+    """Yield ("chrom:pos", record) pairs, one merged fetch window at a time."""
+    # Sweep each chromosome once, fetching every merged ±flank window a single time
+    for chrom, variants in variants_by_chrom.items():
+        positions = sorted(variants)
+        position_array = np.asarray(positions, dtype=np.int64)
+        for start, end, first, last in merge_windows(positions, flanking_bp):
+            window_positions = positions[first:last]
+            window_array = position_array[first:last]
+            records = {
+                pos: {"variant": variants[pos], "pileup_reads": []}
+                for pos in window_positions
+            }
+
+            # Resolve every read's overlapping variants with two vectorized searchsorted calls per window
+            reads = list(bam.fetch(chrom, start, end))
+            read_starts = np.fromiter((read.reference_start for read in reads), dtype=np.int64, count=len(reads))
+            read_ends = np.fromiter(
+                (read.reference_end or read.reference_start + 1 for read in reads), dtype=np.int64, count=len(reads)
+            )
+            # A read overlaps [pos - flank, pos + flank) iff read_start - flank < pos < read_end + flank
+            los = np.searchsorted(window_array, read_starts - flanking_bp, side="right").tolist()
+            his = np.searchsorted(window_array, read_ends + flanking_bp, side="left").tolist()
+
+            for read, lo, hi in zip(reads, los, his):
+                if lo >= hi:
+                    continue
+
+                read_data = {
+                    "query_name": read.query_name,
+                    "reference_start": read.reference_start,
+                    "cigar": read.cigarstring,
+                    "sequence": read.query_sequence,
+                    "mapping_quality": read.mapping_quality,
+                    "is_reverse": read.is_reverse,
+                }
+                for pos in window_positions[lo:hi]:
+                    records[pos]["pileup_reads"].append(read_data)
+
+            for pos in window_positions:
+                yield f"{chrom}:{pos}", records[pos]
+
+
+def write_json_stream(items, output_json):
+    """Write (key, value) pairs as a JSON object, serializing one entry at a time."""
+    with open(output_json, "wb") as json_file:
+        json_file.write(b"{")
+        for i, (key, value) in enumerate(items):
+            if i:
+                json_file.write(b",")
+            json_file.write(orjson.dumps(key))
+            json_file.write(b":")
+            json_file.write(orjson.dumps(value))
+        json_file.write(b"}")
+
+
+# 2-bit base codes (A=0, C=1, G=2, T=3); anything else is recorded in the N mask
+_BASE_CODES = np.zeros(256, dtype=np.uint8)
+_IS_ACGT = np.zeros(256, dtype=bool)
+for _code, _base in enumerate(b"ACGT"):
+    _BASE_CODES[[_base, _base + 32]] = _code  # Upper and lower case
+    _IS_ACGT[[_base, _base + 32]] = True
+# Packed byte -> its four 2-bit codes, most significant first
+_UNPACK_CODES = np.array([[(byte >> shift) & 3 for shift in (6, 4, 2, 0)] for byte in range(256)], dtype=np.uint8)
+
+
+def pack_2bit(seq):
+    """Pack an ASCII sequence (bytes) into 4 bases per byte plus a bitmap of non-ACGT positions."""
+    raw = np.frombuffer(seq, dtype=np.uint8)
+    codes = _BASE_CODES[raw]
+    padding = -len(codes) % 4
+    if padding:
+        codes = np.concatenate([codes, np.zeros(padding, dtype=np.uint8)])
+    quads = codes.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    n_mask = np.packbits(~_IS_ACGT[raw])
+    return packed.tobytes(), n_mask.tobytes()
+
+
+def unpack_2bit(packed, n_mask, length):
+    """Expand a pack_2bit sequence back to ASCII bytes; masked positions come back as N."""
+    codes = _UNPACK_CODES[np.frombuffer(packed, dtype=np.uint8)].ravel()[:length]
+    seq = np.frombuffer(b"ACGT", dtype=np.uint8)[codes]
+    seq[np.unpackbits(np.frombuffer(n_mask, dtype=np.uint8), count=length).astype(bool)] = ord("N")
+    return seq.tobytes()
+
+
+def write_parquet_stream(items, output_path, rows_per_group=100000, pack_sequences=False):
+    """Write pileup records as a Parquet table with one row per (variant, read), flushing row groups as they fill.
+
+    With pack_sequences, the sequence column is replaced by pack_2bit output (sequence_2bit,
+    sequence_n_mask) and sequence_length, roughly a quarter of the bytes.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    variant_fields = [
+        ("chromosome", pa.string()),
+        ("position", pa.int64()),
+        ("reference", pa.string()),
+        ("alternate", pa.string()),
+    ]
+    read_fields = [
+        ("query_name", pa.string()),
+        ("reference_start", pa.int64()),
+        ("cigar", pa.string()),
+        ("mapping_quality", pa.int32()),
+        ("is_reverse", pa.bool_()),
+    ]
+    if pack_sequences:
+        sequence_fields = [
+            ("sequence_2bit", pa.binary()),
+            ("sequence_n_mask", pa.binary()),
+            ("sequence_length", pa.int32()),
+        ]
+    else:
+        sequence_fields = [
+            ("sequence", pa.binary()),  # Raw ASCII bases, readable with np.frombuffer without UTF-8 decoding
+        ]
+    schema = pa.schema(variant_fields + read_fields + sequence_fields)
+    columns = {name: [] for name in schema.names}
+
+    with pq.ParquetWriter(output_path, schema, compression="zstd") as writer:
+        for _, record in items:
+            variant = record["variant"]
+            # Variants without coverage keep a single row with null read columns
+            for read in record["pileup_reads"] or [None]:
+                for name, _ in variant_fields:
+                    columns[name].append(variant[name])
+                for name, _ in read_fields:
+                    columns[name].append(read[name] if read else None)
+
+                sequence = read["sequence"] if read else None
+                if not pack_sequences:
+                    columns["sequence"].append(sequence)
+                elif sequence is None:
+                    for name, _ in sequence_fields:
+                        columns[name].append(None)
+                else:
+                    packed, n_mask = pack_2bit(sequence.encode("ascii"))
+                    columns["sequence_2bit"].append(packed)
+                    columns["sequence_n_mask"].append(n_mask)
+                    columns["sequence_length"].append(len(sequence))
+
+            if len(columns["chromosome"]) >= rows_per_group:
+                writer.write_table(pa.table(columns, schema=schema))
+                columns = {name: [] for name in schema.names}
+
+        if columns["chromosome"]:
+            writer.write_table(pa.table(columns, schema=schema))
+
+
+def extract_pileup_data(bam_file, vcf_file, output_json, flanking_bp=200, threads=None, output_format="json",
+                        pack_sequences=False):
+    # Open BAM file, decompressing BGZF blocks on a pool of htslib threads
+    if threads is None:
+        threads = max(2, (os.cpu_count() or 1) // 2)
+    bam = pysam.AlignmentFile(bam_file, "rb", threads=threads)
+
+    # Read variants from VCF file, grouped by chromosome and keyed by position
+    variants_by_chrom = defaultdict(dict)
     with open(vcf_file, "r") as vcf:
         for line in vcf:
             if line.startswith("#"):
                 continue  # Skip headers
             cols = line.strip().split("\t")
             chrom, pos, ref, alt = cols[0], int(cols[1]), cols[3], cols[4]
-            variants.append((chrom, pos, ref, alt))
-
-    # Dictionary to store pileup data
-    pileup_data = {}
-
-    for chrom, pos, ref, alt in variants:
-        key = f"{chrom}:{pos}"
-        pileup_data[key] = {
-            "variant": {
+            variants_by_chrom[chrom][pos] = {
                 "chromosome": chrom,
                 "position": pos,
                 "reference": ref,
                 "alternate": alt
-            },
-            "pileup_reads": []
-        }
-
-        # Fetch reads within the ±200 bp region
-        for read in bam.fetch(chrom, max(0, pos - flanking_bp), pos + flanking_bp):
-            read_data = {
-                "query_name": read.query_name,
-                "reference_start": read.reference_start,
-                "cigar": read.cigarstring,
-                "sequence": read.query_sequence,
-                "mapping_quality": read.mapping_quality,
-                "is_reverse": read.is_reverse,
             }
-            pileup_data[key]["pileup_reads"].append(read_data)
+
+    # Stream each variant's pileup to disk as soon as its window is complete
+    records = iter_pileup_records(bam, variants_by_chrom, flanking_bp)
+    if output_format == "parquet":
+        write_parquet_stream(records, output_json, pack_sequences=pack_sequences)
+    else:
+        write_json_stream(records, output_json)
 
     # Close BAM file
     bam.close()
 
-    # Write JSON output
-    with open(output_json, "w") as json_file:
-        json.dump(pileup_data, json_file, indent=4)
-
     print(f"Pileup data saved to {output_json}")
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Extract pileup reads within 200bp of variants and save to JSON.")
+    parser = argparse.ArgumentParser(description="Extract pileup reads within 200bp of variants and save to JSON or Parquet.")
     parser.add_argument("-b", "--bam", required=True, help="Input BAM file")
     parser.add_argument("-v", "--vcf", required=True, help="Input VCF file")
-    parser.add_argument("-o", "--output", required=True, help="Output JSON file")
+    parser.add_argument("-o", "--output", required=True, help="Output JSON or Parquet file")
+    parser.add_argument("-f", "--format", choices=["json", "parquet"], default="json", help="Output format (parquet writes one zstd-compressed row per variant/read pair)")
+    parser.add_argument("--pack-sequences", action="store_true", help="With --format parquet, store read sequences 2-bit packed with an N mask")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="Number of BAM decompression threads (default: half the CPUs, at least 2)")
     args = parser.parse_args()
 
-    extract_pileup_data(args.bam, args.vcf, args.output)
+    extract_pileup_data(args.bam, args.vcf, args.output, threads=args.threads, output_format=args.format,
+                        pack_sequences=args.pack_sequences)
@@ -1,29 +1,67 @@
+from cyvcf2 import VCF
 import pysam
-import json
+import orjson
+import os
 import time
 import argparse
 
 
-def read_vcf_pysam(file_path, chromosome=None):
-    vcf_file = pysam.VariantFile(file_path)
-    variants = []
+def ensure_vcf_index(file_path):
+    """Return a tabix-indexed path for the VCF, bgzipping and indexing it if no index exists."""
+    if os.path.exists(file_path + ".tbi") or os.path.exists(file_path + ".csi"):
+        return file_path
 
-    for record in vcf_file:
-        if chromosome and record.chrom != chromosome:
-            continue  # Skip records not on the specified chromosome
+    # A plain .vcf indexed on an earlier run already has its bgzipped, indexed copy next to it
+    compressed_path = file_path + ".gz"
+    if not file_path.endswith(".gz") and (
+        os.path.exists(compressed_path + ".tbi") or os.path.exists(compressed_path + ".csi")
+    ):
+        return compressed_path
 
+    print(f"[INFO] No index found for {file_path}, building tabix index...")
+    return pysam.tabix_index(file_path, preset="vcf", keep_original=True)
+
+
+def read_vcf_cyvcf2(file_path, chromosome=None):
+    """Yield one variant dict per VCF record."""
+    if chromosome:
+        file_path = ensure_vcf_index(file_path)  # Region queries seek through the index
+
+    vcf_file = VCF(file_path)
+    samples = vcf_file.samples
+
+    # Indexed region query instead of scanning and discarding other chromosomes
+    records = vcf_file(chromosome) if chromosome else vcf_file
+
+    for record in records:
+        # Trailing None lets the missing-allele index -1 resolve without a per-allele branch
+        alleles = [record.REF] + record.ALT + [None]
+        lookup = alleles.__getitem__
         variant_data = {
-            "chromosome": record.chrom,
-            "position": record.pos,
-            "reference": record.ref,
-            "alternative": record.alts,
-            "id": record.id,
-            "quality": record.qual,
-            "samples": {sample: record.samples[sample].alleles for sample in record.samples}
+            "chromosome": record.CHROM,
+            "position": record.POS,
+            "reference": record.REF,
+            "alternative": record.ALT or None,  # ALT=. is null, as pysam reported it
+            "id": record.ID,
+            "quality": record.QUAL,
+            # genotypes are [allele_idx, ..., phased]; -1 marks a missing allele. Sites-only VCFs have none
+            "samples": {
+                sample: tuple(map(lookup, gt[:-1]))
+                for sample, gt in zip(samples, record.genotypes or ())
+            }
         }
-        variants.append(variant_data)
+        yield variant_data
+
 
-    return variants
+def write_json_array_stream(items, output_file):
+    """Write items as a JSON array, serializing one element at a time."""
+    with open(output_file, "wb") as f:
+        f.write(b"[")
+        for i, item in enumerate(items):
+            if i:
+                f.write(b",")
+            f.write(orjson.dumps(item))
+        f.write(b"]")
 
 
 def format_chromosome(chromosome):
@@ -44,20 +82,14 @@ if __name__ == "__main__":
 
     start_time = time.time()  # Start time
 
-    vcf_data = read_vcf_pysam(args.vcf_path, chromosome)
-
     # Generate output filename
     output_filename = f"{args.vcf_path.split('/')[-1].split('.')[0]}_variants"
     if chromosome:
         output_filename += f"_{chromosome}"
     output_filename += ".json"
 
-    # Save to JSON file
-    with open(output_filename, "w") as f:
-        json.dump(vcf_data, f, indent=4)
-
-    # Print first 5 entries
-    # print(vcf_data[:5])
+    # Stream variants straight to the JSON file
+    write_json_array_stream(read_vcf_cyvcf2(args.vcf_path, chromosome), output_filename)
 
     end_time = time.time()  # End time
     elapsed_time = end_time - start_time
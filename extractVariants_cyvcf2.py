@@ -1,23 +1,23 @@
-import gzip
-import vcfpy
+from cyvcf2 import VCF
 import json
 import time
 
 
-def read_vcf_vcfpy(file_path):
-    with gzip.open(file_path, "rt") as f:
-        reader = vcfpy.Reader.from_stream(f)
-        variants = []
+def read_vcf_cyvcf2(file_path):
+    # cyvcf2 reads bgzipped VCFs natively through htslib, no Python-side gzip stream needed
+    vcf = VCF(file_path)
+    samples = vcf.samples
+    variants = []
 
-        for record in reader:
-            variant_data = {
-                "chromosome": record.CHROM,
-                "position": record.POS,
-                "reference": record.REF,
-                "alternative": record.ALT,
-                "samples": {call.sample: call.data for call in record.calls}  # Sample genotype data
-            }
-            variants.append(variant_data)
+    for record in vcf:
+        variant_data = {
+            "chromosome": record.CHROM,
+            "position": record.POS,
+            "reference": record.REF,
+            "alternative": record.ALT,
+            "samples": dict(zip(samples, record.gt_bases.tolist()))  # Sample genotype bases, e.g. "A/G"
+        }
+        variants.append(variant_data)
 
     return variants
 
@@ -26,7 +26,7 @@ if __name__ == "__main__":
     start_time = time.time()  # Start time
 
     vcf_path = "./Genome_Bottle_VCF/HG005_GRCh38_1_22_v4.2.1_benchmark.vcf.gz"
-    vcf_data = read_vcf_vcfpy(vcf_path)
+    vcf_data = read_vcf_cyvcf2(vcf_path)
 
     end_time = time.time()  # End time
 
@@ -34,9 +34,8 @@ if __name__ == "__main__":
     print(f"Elapsed time: {elapsed_time:.6f} seconds")
 
     # Save to JSON file
-    with open("HG005_variants_vcfpy.json", "w") as f:
+    with open("HG005_variants_cyvcf2.json", "w") as f:
         json.dump(vcf_data, f, indent=4)
 
     # Print first 5 entries
     print(vcf_data[:5])
-
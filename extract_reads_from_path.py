@@ -1,112 +1,249 @@
 import subprocess
-import json
+import os
+import shutil
+import hashlib
+import base64
+import orjson
 import argparse
-import threading
+import multiprocessing
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import stream  # pystream-protobuf
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.message import DecodeError
+import vg_pb2  # Import VG's Protobuf schema
+
+NODES_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pangenome_ml")
+
+def nodes_cache_path(graph_xg, path_name):
+    """Cache file for a (graph, path) pair; the graph's mtime and size invalidate stale entries."""
+    stat = os.stat(graph_xg)
+    key = hashlib.sha1(f"{os.path.abspath(graph_xg)}:{stat.st_mtime}:{stat.st_size}:{path_name}".encode()).hexdigest()
+    return os.path.join(NODES_CACHE_DIR, f"{key}.nodes.json")
+
+# Graph formats libbdsg can load in-process; XG indexes still go through vg
+BDSG_GRAPH_TYPES = {".pg": "PackedGraph", ".hg": "HashGraph", ".og": "ODGI"}
+
+def extract_nodes_bdsg(graph_file, path_name, output_json):
+    """Walk a path with libbdsg and write its nodes; return False if the graph format cannot be handled here."""
+    graph_type = BDSG_GRAPH_TYPES.get(os.path.splitext(graph_file)[1])
+    if graph_type is None:
+        return False
+
+    import bdsg
+    graph = getattr(bdsg.bdsg, graph_type)()
+    graph.deserialize(graph_file)
+    if not graph.has_path(path_name):
+        raise ValueError(f"Path {path_name} not found in {graph_file}")
+
+    nodes = {}
+    def visit(step):
+        handle = graph.get_handle_of_step(step)
+        node_id = graph.get_id(handle)
+        if node_id not in nodes:
+            nodes[node_id] = graph.get_sequence(graph.forward(handle))
+        return True
+
+    graph.for_each_step_in_path(graph.get_path_handle(path_name), visit)
+
+    with open(output_json, "wb") as f:
+        f.write(orjson.dumps({"nodes": [{"id": node_id, "sequence": seq} for node_id, seq in nodes.items()]}))
+    return True
 
 def extract_nodes(graph_xg, path_name, output_json="nodes.json"):
     """Extract nodes with ID, sequence, and length from a given path."""
-    path_vg = graph_xg.replace(".xg", ".vg")
+    cache_file = nodes_cache_path(graph_xg, path_name)
+    if os.path.exists(cache_file):
+        shutil.copyfile(cache_file, output_json)
+        print(f"[✔] Reused cached nodes for path {path_name}, saved to {output_json}")
+        return
+
+    if extract_nodes_bdsg(graph_xg, path_name, output_json):
+        populate_nodes_cache(output_json, cache_file)
+        print(f"[✔] Extracted node IDs, sequences in-process with libbdsg, and saved to {output_json}")
+        return
+
+    # Intermediate subgraph next to the graph; the extra suffix keeps it from ever being the input file itself
+    path_vg = os.path.splitext(graph_xg)[0] + ".path.vg"
 
     # Run vg find to extract nodes from the path
-    subprocess.run(f"vg find -x {graph_xg} -p {path_name} > {path_vg}", shell=True, check=True)
+    with open(path_vg, "wb") as f:
+        subprocess.run(["vg", "find", "-x", graph_xg, "-p", path_name], stdout=f, check=True)
+
+    # Convert nodes to JSON format including sequence; both exit codes are checked, not just jq's
+    with open(output_json, "wb") as f:
+        view = subprocess.Popen(["vg", "view", "-v", path_vg], stdout=subprocess.PIPE)
+        jq = subprocess.Popen(["jq", "-c", "{nodes: [.node[] | {id: .id, sequence: .sequence}]}"], stdin=view.stdout, stdout=f)
+        view.stdout.close()  # jq owns the pipe now
+        jq.wait()
+        view.wait()
+    if view.returncode != 0:
+        raise subprocess.CalledProcessError(view.returncode, view.args)
+    if jq.returncode != 0:
+        raise subprocess.CalledProcessError(jq.returncode, jq.args)
 
-    # Convert nodes to JSON format including sequence
-    subprocess.run(f"vg view -v {path_vg} | jq -c '{{nodes: [.node[] | {{id: .id, sequence: .sequence}}]}}' > {output_json}", shell=True, check=True)
+    # Only a parseable, non-empty node list is cached; anything else would be reused on every later run
+    with open(output_json, "rb") as f:
+        try:
+            nodes = orjson.loads(f.read()).get("nodes")
+        except (orjson.JSONDecodeError, AttributeError):
+            nodes = None
+    if not nodes:
+        raise RuntimeError(f"vg returned no nodes for path {path_name} in {graph_xg}")
 
+    populate_nodes_cache(output_json, cache_file)
     print(f"[✔] Extracted node IDs, sequences, and saved to {output_json}")
 
+def populate_nodes_cache(output_json, cache_file):
+    """Copy extracted nodes into the cache atomically so an interrupted copy is never reused."""
+    os.makedirs(NODES_CACHE_DIR, exist_ok=True)
+    shutil.copyfile(output_json, cache_file + ".tmp")
+    os.replace(cache_file + ".tmp", cache_file)
+
 def load_nodes(nodes_json):
     """Load node IDs, sequences, and compute their lengths."""
-    with open(nodes_json, "r") as f:
-        data = json.load(f)
+    with open(nodes_json, "rb") as f:
+        data = orjson.loads(f.read())
 
     node_info = {}
     for node in data["nodes"]:
-        node_id = str(node["id"])
+        node_id = int(node["id"])  # Integer keys match Alignment node_ids without str() conversion
         sequence = node["sequence"]
         node_info[node_id] = {"sequence": sequence, "length": len(sequence)}
 
     return node_info
 
-def process_read(line, node_info, node_read_map, lock):
-    """Check if the read aligns to any node and store it grouped by node."""
+# vg starts every group of a GAM with this type tag message; it is not an Alignment
+GAM_TYPE_TAG = b"GAM"
+
+# Node IDs of interest, set once per worker process by init_worker
+_NODE_IDS = frozenset()
+
+def init_worker(node_ids):
+    """Store the node ID set in each worker so it is pickled once, not per task."""
+    global _NODE_IDS
+    _NODE_IDS = node_ids
+
+def process_read(data):
+    """Check if the serialized Alignment maps to any node; return (node_ids, read_info) or None."""
+    read = vg_pb2.Alignment()
     try:
-        read = json.loads(line)
-        read_info = {
-            "read_name": read["name"],
-            "sequence": read["sequence"],
-            "mapping_quality": read.get("mapping_quality", 0),
-            "score": read.get("score", None),
-            "quality": read.get("quality", ""),
-            "path": read.get("path", {})
-        }
-
-        mapped_nodes = set()  # Store unique node IDs the read maps to
-        for mapping in read.get("path", {}).get("mapping", []):
-            node_id = str(mapping["position"].get("node_id", ""))
-            if node_id in node_info:
-                mapped_nodes.add(node_id)
-
-        # Immediately store the read into the dictionary
-        with lock:
-            for node_id in mapped_nodes:
-                if node_id not in node_read_map:
-                    node_read_map[node_id] = {
-                        "sequence": node_info[node_id]["sequence"],
-                        "length": node_info[node_id]["length"],
+        read.ParseFromString(data)
+    except DecodeError:
+        print("⚠️ Skipping a corrupted read")
+        return None
+
+    # Unique node IDs the read maps to, deduplicated and filtered in one set intersection
+    mapped_nodes = {mapping.position.node_id for mapping in read.path.mapping} & _NODE_IDS
+
+    if not mapped_nodes:
+        return None
+
+    # Same fields and encoding as `vg view -a`: proto3 defaults omitted, quality base64-encoded
+    read_info = {
+        "read_name": read.name,
+        "sequence": read.sequence,
+        "mapping_quality": read.mapping_quality,
+        "score": read.score or None,
+        "quality": base64.b64encode(read.quality).decode("ascii"),
+        "path": MessageToDict(read.path, preserving_proto_field_name=True)
+    }
+    return sorted(mapped_nodes), read_info
+
+def process_batch(records):
+    """Process a batch of serialized reads; return the batch size and the (node_ids, read_info) of matching reads."""
+    results = []
+    for data in records:
+        result = process_read(data)
+        if result:
+            results.append(result)
+    return len(records), results
+
+def iter_batches(records, batch_size):
+    """Group an iterable of records into lists of at most batch_size records."""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def group_reads_by_node(ndjson_path, node_info):
+    """Group the streamed NDJSON reads by node in a single pass."""
+    node_read_map = {}
+    with open(ndjson_path, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            for node_id in record["nodes"]:
+                node_data = node_read_map.get(node_id)
+                if node_data is None:
+                    info = node_info[node_id]
+                    node_data = node_read_map[node_id] = {
+                        "sequence": info["sequence"],
+                        "length": info["length"],
                         "reads": []
                     }
-                node_read_map[node_id]["reads"].append(read_info)
-
-    except json.JSONDecodeError:
-        return  # Skip invalid JSON reads
+                node_data["reads"].append(record["read"])
+    return node_read_map
 
-def filter_reads(input_gam, nodes_file, output_json, threads=4):
-    """Filter reads from GAM that align to extracted nodes and group them by node in real-time."""
+def filter_reads(input_gam, nodes_file, output_json, threads=4, batch_size=1000, verbose=False):
+    """Filter reads from GAM that align to extracted nodes and group them by node; progress is printed only when verbose."""
     # Load node information (id, sequence, length)
     node_info = load_nodes(nodes_file)
 
-    # Shared data structure for storing grouped reads
-    node_read_map = {}
-    lock = threading.Lock()  # Ensures thread-safe writing to the dictionary
-
-    # Start GAM file processing
-    process = subprocess.Popen(["vg", "view", "-a", input_gam], stdout=subprocess.PIPE, text=True)
+    # Matching reads are appended to an NDJSON file while streaming; grouping happens once at the end
+    ndjson_path = output_json + ".ndjson"
 
     processed_count = 0
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        for _ in executor.map(lambda line: process_read(line, node_info, node_read_map, lock), process.stdout):
-            processed_count += 1
-            if processed_count % 5000 == 0:
-                print(f"[INFO] Processed {processed_count} reads...")
-                with lock:
-                    save_json(node_read_map, output_json)
-
-    # Final save
-    save_json(node_read_map, output_json)
+    # Read length-delimited Alignment messages straight from the GAM, no `vg view -a` JSON round trip
+    with stream.open(input_gam, "rb") as gam, open(ndjson_path, "wb") as ndjson_file:
+        # Worker processes sidestep the GIL; they only need the node IDs, sequences stay in the parent
+        with multiprocessing.Pool(threads, initializer=init_worker, initargs=(frozenset(node_info),)) as pool:
+            # Tags are skipped here rather than with stream.open(header=...), which rejects groups holding more than one read
+            reads = (message for message in gam if message != GAM_TYPE_TAG)
+            batches = iter_batches(reads, batch_size)
+            for batch_count, batch_results in pool.imap(process_batch, batches, chunksize=4):
+                # Only the main process writes, once per batch
+                for node_ids, read_info in batch_results:
+                    ndjson_file.write(orjson.dumps({"nodes": node_ids, "read": read_info}) + b"\n")
+                processed_count += batch_count
+                if verbose and processed_count % 5000 < batch_count:
+                    print(f"[INFO] Processed {processed_count} reads...")
+
+    print(f"[INFO] Processed {processed_count} reads in total")
+
+    # Single grouping pass and save once every read has been streamed
+    save_json(group_reads_by_node(ndjson_path, node_info), output_json)
+    os.remove(ndjson_path)
     print(f"[✔] Filtered reads grouped by node saved to {output_json}")
     return output_json
 
 def save_json(data, output_file):
-    """Saves the current JSON state to a file atomically."""
+    """Saves the current JSON state to a file atomically, streaming one node at a time."""
     temp_file = output_file + ".tmp"
-    with open(temp_file, "w") as f:
-        json.dump(data, f, indent=2)
-    subprocess.run(["mv", temp_file, output_file])  # Atomic move
+    with open(temp_file, "wb") as f:
+        f.write(b"{")
+        for i, (node_id, node_data) in enumerate(data.items()):
+            if i:
+                f.write(b",")
+            f.write(orjson.dumps(str(node_id)))  # JSON object keys must be strings
+            f.write(b":")
+            f.write(orjson.dumps(node_data))
+        f.write(b"}")
+    os.replace(temp_file, output_file)  # Atomic rename, no fork/exec of mv
     print(f"[✔] Saved progress to {output_file}")
 
 def main():
     """Main function with argument parsing."""
     parser = argparse.ArgumentParser(description="Extract reads from a GAM file that align to a specific path and group them by node.")
 
-    parser.add_argument("-x", "--xg", required=True, help="Graph XG file")
+    parser.add_argument("-x", "--xg", required=True, help="Graph XG file (PackedGraph .pg, HashGraph .hg or ODGI .og files are read in-process with libbdsg)")
     parser.add_argument("-g", "--gam", required=True, help="Input GAM file")
     parser.add_argument("-p", "--path", required=True, help="Path name to filter reads")
     parser.add_argument("-n", "--nodes", default="hg38_chr5_nodes.json", help="Output JSON file for extracted node data")
     parser.add_argument("-j", "--json", default="grouped_reads_by_hg38_chr5_nodes.json", help="Output JSON file grouping reads by node")
-    parser.add_argument("-t", "--threads", type=int, default=4, help="Number of threads for processing")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Number of worker processes for processing")
+    parser.add_argument("--verbose", action="store_true", help="Print progress while streaming reads")
 
     args = parser.parse_args()
 
@@ -114,7 +251,7 @@ def main():
     extract_nodes(args.xg, args.path, args.nodes)
 
     # Process reads from GAM and group them by node
-    filter_reads(args.gam, args.nodes, args.json, args.threads)
+    filter_reads(args.gam, args.nodes, args.json, args.threads, verbose=args.verbose)
 
 if __name__ == "__main__":
     main()
@@ -1,232 +1,343 @@
 import subprocess
 import os
-import json
+import orjson
+import numpy as np
 import argparse
-import re
+import mmap
 import multiprocessing
-import glob
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
 import gc
 
 
-def extract_nodes_from_gfa(gfa_file, reference_name, chromosome, output_json="nodes.json", threads=4):
-    """Extract nodes from GFA path and directly assign node information if available using multi-threading."""
+def iter_gfa_lines(mm, record_type, start=0, end=None):
+    """Yield the lines of a given GFA record type that start within mm[start:end], skipping all other lines."""
+    if end is None:
+        end = len(mm)
+    tag = b"\n" + record_type + b"\t"
+    if start == 0 and mm[:len(tag) - 1] == tag[1:]:
+        line_start = 0
+    else:
+        found = mm.find(tag, max(start - 1, 0))
+        line_start = found + 1 if found != -1 else len(mm)
+
+    while line_start < end:
+        line_end = mm.find(b"\n", line_start)
+        if line_end == -1:
+            line_end = len(mm)
+        yield mm[line_start:line_end]
+        found = mm.find(tag, line_end)
+        line_start = found + 1 if found != -1 else len(mm)
+
+
+def split_line_ranges(mm, parts):
+    """Split the mapped file into up to `parts` byte ranges that each start at a line boundary."""
+    size = len(mm)
+    bounds = [0]
+    for i in range(1, parts):
+        newline = mm.find(b"\n", size * i // parts)
+        bounds.append(size if newline == -1 else newline + 1)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def extract_nodes_from_gfa(gfa_file, reference_name, chromosome, output_json="nodes.json", threads=4, verbose=False):
+    """Extract nodes from GFA path and directly assign node information if available using worker processes."""
+    with open(gfa_file, "rb") as gfa:
+        mm = mmap.mmap(gfa.fileno(), 0, access=mmap.ACCESS_READ)
+
     print("[INFO] Starting path extraction...")
-    command = f"grep '^W' {gfa_file} | grep '{reference_name}' | grep '{chromosome}'"
-    result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    reference = reference_name.encode()
+    chrom = chromosome.encode()
 
     path_nodes = {}
     processed_count = 0
-    for line in result.stdout.strip().split('\n'):
-        parts = line.split('\t')
+    for line in iter_gfa_lines(mm, b"W"):
+        if reference not in line or chrom not in line:
+            continue
+        parts = line.split(b"\t")
         if len(parts) >= 7:
-            sequence = parts[6].strip()
-            nodes = re.findall(r'[><][^><]+', sequence)
+            sequence = parts[6].strip().decode()
+            # Split the walk in front of every orientation mark; the text before the first mark is not a node
+            nodes = sequence.replace("<", "\t<").replace(">", "\t>").split("\t")[1:]
             for n in nodes:
                 strand = n[0]
                 node_id = n[1:]
                 path_nodes[node_id] = {"strand": strand}
-                processed_count += 1
-                if processed_count % 100000 == 0:
-                    print(f"[INFO] Extracted {processed_count} nodes from paths...")
+            processed_count += len(nodes)
+            if verbose:
+                print(f"[INFO] Extracted {processed_count} nodes from paths...")
 
     print(f"[✔] Path extraction complete. {processed_count} nodes extracted.")
 
-    path_node_ids = set(path_nodes.keys())
-    lock = threading.Lock()
-    node_data = {}
+    print("[INFO] Starting segment processing...")
     processed_count = 0
-
-    def process_chunk(chunk):
-        local_data = {}
-        nonlocal processed_count
-        for line in chunk:
-            if line.startswith('S'):
-                parts = line.strip().split('\t')
-                if len(parts) >= 6:
-                    node_id = parts[1]
-                    if node_id in path_node_ids:
-                        sequence = parts[2]
-                        start_offset = int(parts[5].split(':')[2])  # Extract SO from parts[5]
-                        local_data[node_id] = {
-                            "sequence": sequence,
-                            "length": len(sequence),
-                            "start_offset": start_offset
-                        }
-                        processed_count += 1
-                        if processed_count % 100000 == 0:
-                            print(f"[INFO] Processed {processed_count} nodes with sequence data...")
-
-        with lock:
+    # Worker processes map the file themselves; only byte ranges go out and matching segments come back
+    path_node_ids = frozenset(node_id.encode() for node_id in path_nodes)
+    node_data = {}
+    with multiprocessing.Pool(threads, initializer=init_segment_worker, initargs=(gfa_file, path_node_ids)) as pool:
+        # A few ranges per worker keeps the pool busy when segment density is uneven across the file
+        for local_data in pool.imap_unordered(process_segment_range, split_line_ranges(mm, threads * 4)):
             node_data.update(local_data)
+            processed_count += len(local_data)
+            if verbose:
+                print(f"[INFO] Processed {processed_count} nodes with sequence data...")
 
-    print("[INFO] Starting segment processing...")
-    with open(gfa_file, 'r') as gfa:
-        lines = gfa.readlines()
-        chunk_size = len(lines) // threads
-        chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
-
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = [executor.submit(process_chunk, chunk) for chunk in chunks]
-        for future in as_completed(futures):
-            future.result()
-
+    mm.close()
     print(f"[✔] Segment processing complete. {processed_count} nodes with sequences processed.")
 
-    for node_id in path_nodes.keys():
-        if node_id in node_data:
-            path_nodes[node_id].update(node_data[node_id])
-
-    with open(output_json, 'w') as f:
-        json.dump({"nodes": path_nodes}, f, indent=2)
-
-    print(f"[✔] Extracted nodes with IDs, strands, sequences, lengths, and start offsets using {threads} threads, and saved to {output_json}")
-
-
-def load_nodes(nodes_json):
-    """Load node IDs, strands, sequences, and lengths from JSON."""
-    with open(nodes_json, "r") as f:
-        return json.load(f)["nodes"]
-
-
-def process_read(line, node_info):
-    """Process a single read and map it to a node."""
+    # node_data only holds path nodes, so walk it instead of probing it for every path node
+    for node_id, segment in node_data.items():
+        path_nodes[node_id].update(segment)
+
+    if output_json.endswith(".feather"):
+        write_nodes_feather(path_nodes, output_json)
+    else:
+        with open(output_json, 'wb') as f:
+            f.write(orjson.dumps({"nodes": path_nodes}, option=orjson.OPT_INDENT_2))
+
+    print(f"[✔] Extracted nodes with IDs, strands, sequences, lengths, and start offsets using {threads} processes, and saved to {output_json}")
+
+
+# Mapped GFA file and path node IDs, set once per segment worker process by init_segment_worker
+_GFA_MM = None
+_PATH_NODE_IDS = frozenset()
+
+
+def init_segment_worker(gfa_file, path_node_ids):
+    """Map the GFA file and store the path node IDs in each segment worker."""
+    global _GFA_MM, _PATH_NODE_IDS
+    with open(gfa_file, "rb") as gfa:
+        _GFA_MM = mmap.mmap(gfa.fileno(), 0, access=mmap.ACCESS_READ)
+    _PATH_NODE_IDS = path_node_ids
+
+
+def process_segment_range(byte_range):
+    """Collect the path-node segments whose S-lines start within the given byte range."""
+    start, end = byte_range
+    local_data = {}
+    for line in iter_gfa_lines(_GFA_MM, b"S", start, end):
+        # Split off only the node ID first; the sequence is copied out only for path nodes
+        node_id = line.split(b"\t", 2)[1]
+        if node_id in _PATH_NODE_IDS:
+            parts = line.rstrip().split(b"\t")
+            if len(parts) >= 6:
+                sequence = parts[2].decode()
+                start_offset = int(parts[5].split(b':')[2])  # Extract SO from parts[5]
+                local_data[node_id.decode()] = {
+                    "sequence": sequence,
+                    "length": len(sequence),
+                    "start_offset": start_offset
+                }
+    return local_data
+
+
+def write_nodes_feather(path_nodes, output_path):
+    """Write path nodes as an uncompressed Feather (Arrow IPC) table, one column per field, so it can be memory-mapped."""
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    nodes = list(path_nodes.values())
+    table = pa.table({
+        "id": pa.array(list(path_nodes), pa.string()),
+        "strand": pa.array([ord(node["strand"]) for node in nodes], pa.uint8()),
+        "sequence": pa.array([node.get("sequence") for node in nodes], pa.large_string()),
+        "length": pa.array([node.get("length") for node in nodes], pa.int32()),
+        "start_offset": pa.array([node.get("start_offset") for node in nodes], pa.int64()),
+    })
+    feather.write_feather(table, output_path, compression="uncompressed")
+
+
+def load_nodes(nodes_file):
+    """Load nodes as a {node_id: row} index plus one column per field (strand, sequence, length, start_offset).
+
+    Nodes without segment data have a None sequence and -1 length and start offset.
+    """
+    if nodes_file.endswith(".feather"):
+        import pyarrow.feather as feather
+
+        table = feather.read_table(nodes_file, memory_map=True)
+        ids = table.column("id").to_pylist()
+        columns = {
+            "strand": table.column("strand").to_numpy(),
+            "sequence": table.column("sequence").to_pylist(),
+            "length": table.column("length").fill_null(-1).to_numpy(),
+            "start_offset": table.column("start_offset").fill_null(-1).to_numpy(),
+        }
+    else:
+        with open(nodes_file, "rb") as f:
+            nodes = orjson.loads(f.read())["nodes"]
+        ids = list(nodes)
+        values = nodes.values()
+        columns = {
+            "strand": np.fromiter((ord(node["strand"]) for node in values), dtype=np.uint8, count=len(ids)),
+            "sequence": [node.get("sequence") for node in values],
+            "length": np.fromiter((node.get("length", -1) for node in values), dtype=np.int32, count=len(ids)),
+            "start_offset": np.fromiter((node.get("start_offset", -1) for node in values), dtype=np.int64, count=len(ids)),
+        }
+
+    # Parallel arrays instead of a dict per node; the index is the only per-node Python object
+    node_index = {node_id: row for row, node_id in enumerate(ids)}
+    return node_index, columns
+
+
+def node_metadata(columns, row):
+    """Rebuild the strand/sequence/length/start_offset entry for one node row."""
+    length = int(columns["length"][row])
+    start_offset = int(columns["start_offset"][row])
+    return {
+        "strand": chr(columns["strand"][row]),
+        "sequence": columns["sequence"][row],
+        "length": length if length >= 0 else None,
+        "start_offset": start_offset if start_offset >= 0 else None,
+    }
+
+
+# Node IDs of interest, set once per worker process by init_worker
+_NODE_IDS = frozenset()
+
+
+def init_worker(node_ids):
+    """Store the node ID set in each worker so it is pickled once, not per task."""
+    global _NODE_IDS
+    _NODE_IDS = node_ids
+
+
+def process_read(read):
+    """Process a single parsed read; return (node_ids, read_info) if it maps to any node of interest."""
+    mappings = read.get("path", {}).get("mapping", ())
+
+    # Deduplicate and test membership in one C-level set intersection
+    mapped_nodes = {str(mapping["position"].get("node_id", "")) for mapping in mappings} & _NODE_IDS
+
+    if not mapped_nodes:
+        return None
+
+    read_info = {
+        "read_name": read["name"],
+        "sequence": read["sequence"],
+        "mapping_quality": read.get("mapping_quality", 0),
+        "score": read.get("score", None),
+        "quality": read.get("quality", ""),
+        "path": read.get("path", {})
+    }
+    return mapped_nodes, read_info
+
+
+def parse_reads(lines):
+    """Parse a batch of JSON lines with a single orjson call, falling back to per-line parsing around invalid lines."""
     try:
-        read = json.loads(line)
-        mapped_nodes = {}
-
-        for mapping in read.get("path", {}).get("mapping", []):
-            node_id = str(mapping["position"].get("node_id", ""))
-            if node_id in node_info:
-                if node_id not in mapped_nodes:
-                    mapped_nodes[node_id] = {
-                        "strand": node_info[node_id]["strand"],
-                        "sequence": node_info[node_id]["sequence"],
-                        "length": node_info[node_id]["length"],
-                        "start_offset": node_info[node_id]["start_offset"],
-                        "reads": []
-                    }
-                mapped_nodes[node_id]["reads"].append({
-                    "read_name": read["name"],
-                    "sequence": read["sequence"],
-                    "mapping_quality": read.get("mapping_quality", 0),
-                    "score": read.get("score", None),
-                    "quality": read.get("quality", ""),
-                    "path": read.get("path", {})
-                })
-        return mapped_nodes if mapped_nodes else None
-
-    except json.JSONDecodeError:
-        return None  # Skip invalid JSON reads
-
-
-def filter_reads(input_gam, nodes_file, output_json, tmp_dir, threads=4):
-    """Filter reads from GAM that align to extracted nodes and group them by node using threading."""
+        return orjson.loads(b"[" + b",".join(lines) + b"]")
+    except orjson.JSONDecodeError:
+        reads = []
+        for line in lines:
+            try:
+                reads.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue  # Skip invalid JSON reads
+        return reads
+
+
+def process_batch(lines):
+    """Process a batch of reads; return the batch size and the (node_ids, read_info) of every read that hit a node."""
+    results = []
+    for read in parse_reads(lines):
+        result = process_read(read)
+        if result:
+            results.append(result)
+    return len(lines), results
+
+
+def iter_batches(lines, batch_size):
+    """Group an iterable of lines into lists of at most batch_size lines."""
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def group_reads_by_node(ndjson_path, node_index, columns):
+    """Group the streamed NDJSON reads by node in a single pass."""
+    node_read_map = {}
+    with open(ndjson_path, "rb") as f:
+        for line in f:
+            record = orjson.loads(line)
+            for node_id in record["nodes"]:
+                node_data = node_read_map.get(node_id)
+                if node_data is None:
+                    node_data = node_read_map[node_id] = node_metadata(columns, node_index[node_id])
+                    node_data["reads"] = []
+                node_data["reads"].append(record["read"])
+    return node_read_map
+
+
+def filter_reads(input_gam, nodes_file, output_json, tmp_dir, threads=4, read_batch_size=1000, verbose=False):
+    """Filter reads from GAM that align to extracted nodes and group them by node using worker processes."""
     print("[INFO] Starting read filtering...")
-    node_info = load_nodes(nodes_file)  # Load node info once
+    node_index, columns = load_nodes(nodes_file)  # Load node info once
 
-    process = subprocess.Popen(["vg", "view", "-a", input_gam], stdout=subprocess.PIPE, text=True)
+    # Binary pipe with a large buffer: orjson parses the raw bytes, no text-mode line decoding
+    process = subprocess.Popen(["vg", "view", "-a", input_gam], stdout=subprocess.PIPE, bufsize=1 << 20)
+
+    # Matching reads are appended to an NDJSON file while streaming, one line per read however many nodes it hits
+    os.makedirs(tmp_dir, exist_ok=True)
+    ndjson_path = os.path.join(tmp_dir, os.path.basename(output_json) + ".ndjson")
 
-    results = []
     processed_count = 0
-    batch_index = 1
-    batch_size = 20000000  # Save every 2,000,000 reads
-
-    lock = threading.Lock()  # Lock for thread safety
-
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = []
-
-        for line in iter(process.stdout.readline, ''):  # Stream lines one by one
-            future = executor.submit(process_read, line, node_info)
-            futures.append(future)
-
-            with lock:  # Ensure atomic update of shared variables
-                processed_count += 1
-                if processed_count % 1000000 == 0:
-                    print(f"[INFO] Processed {processed_count} reads...")
-
-            # Save and clear memory periodically
-            if processed_count % batch_size == 0:
-                with lock:
-                    for future in as_completed(futures):
-                        mapped_nodes = future.result()
-                        if mapped_nodes:
-                            results.append(mapped_nodes)
-
-                    if results:
-                        batch_file = f"./{tmp_dir}/{output_json}_batch_{batch_index}.json"
-                        save_json(results, batch_file)
-                        print(f"[INFO] Saved batch {batch_index} with {len(results)} records")
-                        results.clear()  # Free memory
-                        batch_index += 1
-
-                    futures.clear()  # Clear pending futures to free memory
-
-    # Process any remaining reads
-    with lock:
-        for future in as_completed(futures):
-            mapped_nodes = future.result()
-            if mapped_nodes:
-                results.append(mapped_nodes)
-
-        if results:
-            batch_file = f"./{tmp_dir}/{output_json}_batch_final.json"
-            save_json(results, batch_file)
-            print(f"[INFO] Saved final batch with {len(results)} records")
-
-    merge_json_files(tmp_dir, output_json)
+    # Workers only receive the node IDs; strand/sequence metadata is attached when grouping
+    with open(ndjson_path, "wb") as ndjson_file, \
+            multiprocessing.Pool(threads, initializer=init_worker, initargs=(frozenset(node_index),)) as pool:
+        batches = iter_batches(process.stdout, read_batch_size)
+        for batch_count, batch_results in pool.imap_unordered(process_batch, batches, chunksize=4):
+            for node_ids, read_info in batch_results:
+                ndjson_file.write(orjson.dumps({"nodes": sorted(node_ids), "read": read_info}) + b"\n")
+
+            processed_count += batch_count
+            if verbose and processed_count % 1000000 < batch_count:
+                print(f"[INFO] Processed {processed_count} reads...")
+
+    print(f"[INFO] Processed {processed_count} reads in total")
+
+    # Single grouping pass once every read has been streamed; no batch files to merge
+    save_json(group_reads_by_node(ndjson_path, node_index, columns), output_json)
+    os.remove(ndjson_path)
     print(f"[✔] Filtered reads grouped by node saved to {output_json}")
 
 
 def save_json(data, output_file):
-    """Saves the current JSON state to a file atomically."""
+    """Saves the current JSON state to a file atomically, streaming one node at a time."""
     temp_file = output_file + ".tmp"
-    os.makedirs(os.path.dirname(temp_file), exist_ok=True)
-    with open(temp_file, "w") as f:
-        json.dump(data, f, indent=2)
+    os.makedirs(os.path.dirname(temp_file) or ".", exist_ok=True)
+    with open(temp_file, "wb") as f:
+        f.write(b"{")
+        for i, (node_id, node_data) in enumerate(data.items()):
+            if i:
+                f.write(b",")
+            f.write(orjson.dumps(node_id))
+            f.write(b":")
+            f.write(orjson.dumps(node_data))
+        f.write(b"}")
     os.replace(temp_file, output_file)
     print(f"[✔] Saved progress to {output_file}")
 
 
-def merge_json_files(temp_dir, output_file):
-    """Merge all batch JSON files into one final JSON file."""
-    print("[INFO] Merging all batch JSON files...")
-    merged_data = {}
-
-    batch_files = sorted(glob.glob(f"{temp_dir}/{output_file}_batch_*.json"))
-
-    for batch_file in batch_files:
-        print(f"  - Loading {batch_file}")
-        with open(batch_file, 'r') as f:
-            batch_data = json.load(f)
-            for node_id, node_data in batch_data.items():
-                if node_id not in merged_data:
-                    merged_data[node_id] = node_data
-                else:
-                    merged_data[node_id]["reads"].extend(node_data["reads"])
-
-    with open(output_file, 'w') as f:
-        json.dump(merged_data, f, indent=2)
-    print(f"[✔] Merged data saved to {output_file}")
-
-
 def main():
     parser = argparse.ArgumentParser(description="Extract reads from a GAM file that align to specific nodes from a GFA file and group them by node.")
     parser.add_argument("-gfa", "--gfa_file", required=False, help="GFA graph file")
     parser.add_argument("-r", "--reference", required=False, help="Reference name to filter (e.g., GRCh38)")
     parser.add_argument("-c", "--chromosome", required=False, help="Chromosome name to filter (e.g., chr1)")
     parser.add_argument("-gam", "--gam", required=True, help="Input GAM file")
-    parser.add_argument("-n", "--nodes", default="nodes.json", help="Output JSON file for extracted node data")
+    parser.add_argument("-n", "--nodes", default="nodes.json", help="Output file for extracted node data (JSON, or Feather when it ends in .feather)")
     parser.add_argument("-j", "--json", default="grouped_reads.json", help="Output JSON file grouping reads by node")
-    parser.add_argument("-t", "--threads", type=int, default=4, help="Number of threads for processing")
-    parser.add_argument("--tmp", default="tmp", help="The temporal directory of the output JSON files")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Number of worker processes for the segment scan and read filtering")
+    parser.add_argument("--tmp", default="tmp", help="Directory for the intermediate NDJSON file of matching reads")
+    parser.add_argument("--verbose", action="store_true", help="Print progress while scanning the graph and streaming reads")
 
     args = parser.parse_args()
 
-    # extract_nodes_from_gfa(args.gfa_file, args.reference, args.chromosome, args.nodes, args.threads)
-    filter_reads(args.gam, args.nodes, args.json, args.tmp, args.threads)
+    # extract_nodes_from_gfa(args.gfa_file, args.reference, args.chromosome, args.nodes, args.threads, args.verbose)
+    filter_reads(args.gam, args.nodes, args.json, args.tmp, args.threads, verbose=args.verbose)
 
 
 if __name__ == "__main__":
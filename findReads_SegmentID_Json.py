@@ -1,14 +1,12 @@
-import json
+import orjson
 import argparse
 import os
 import subprocess
-import threading
-import queue
 
 def extract_nodes(json_file_path):
     """Extracts node (segment) IDs for each genomic region from the given JSON file."""
-    with open(json_file_path, "r") as f:
-        data = json.load(f)
+    with open(json_file_path, "rb") as f:
+        data = orjson.loads(f.read())
 
     node_dict = {}
 
@@ -19,54 +17,54 @@ def extract_nodes(json_file_path):
 
     return node_dict
 
-def extract_reads_from_gam(gam_file, segment_ids):
-    """Extracts reads from a GAM file that map to a given region's segment IDs."""
-    result = subprocess.run(['vg', 'view', '-a', gam_file], stdout=subprocess.PIPE, text=True)
+def build_node_to_regions(nodes_dict):
+    """Invert {region: segment_ids} into {node_id: [regions]} so each read mapping is one dict lookup."""
+    node_to_regions = {}
+    for region, segment_ids in nodes_dict.items():
+        for node_id in segment_ids:
+            node_to_regions.setdefault(str(node_id), []).append(region)
+    return node_to_regions
 
-    if result.returncode != 0:
-        print(f"Error running vg view on {gam_file}")
-        return []
+def extract_reads_from_gam(gam_file, nodes_dict):
+    """Extracts reads from a GAM file that map to each region's segment IDs in a single vg view pass."""
+    node_to_regions = build_node_to_regions(nodes_dict)
+    region_reads = {region: set() for region in nodes_dict}
 
-    matching_reads = set()
+    # Binary pipe with a large buffer: orjson parses the raw bytes, no text-mode line decoding
+    process = subprocess.Popen(['vg', 'view', '-a', gam_file], stdout=subprocess.PIPE, bufsize=1 << 20)
 
-    for line in result.stdout.strip().split('\n'):
-        read = json.loads(line)
+    for line in process.stdout:
+        read = orjson.loads(line)
 
-        if 'path' in read:
-            for mapping in read['path']['mapping']:
-                if 'position' in mapping and 'node_id' in mapping['position']:
-                    if str(mapping['position']['node_id']) in segment_ids:
-                        matching_reads.add(read['name'])
-                        break
+        for mapping in read.get('path', {}).get('mapping', ()):
+            node_id = mapping.get('position', {}).get('node_id')
+            if node_id is not None:
+                for region in node_to_regions.get(str(node_id), ()):
+                    region_reads[region].add(read['name'])
 
-    return matching_reads
+    process.stdout.close()
+    if process.wait() != 0:
+        print(f"Error running vg view on {gam_file}")
+        return {region: set() for region in nodes_dict}
 
-def extract_reads_from_gaf(gaf_file, segment_ids):
-    """Extracts reads from a GAF file that map to a given region's segment IDs."""
-    matching_reads = set()
+    return region_reads
+
+def extract_reads_from_gaf(gaf_file, nodes_dict):
+    """Extracts reads from a GAF file that map to each region's segment IDs in a single pass."""
+    node_to_regions = build_node_to_regions(nodes_dict)
+    region_reads = {region: set() for region in nodes_dict}
 
     with open(gaf_file, 'r') as f:
         for line in f:
             columns = line.strip().split("\t")
             if len(columns) > 5:
-                path = columns[5]  # Segment/path information
-                for node in segment_ids:
-                    if node in path:
-                        matching_reads.add(columns[0])  # Read name
-                        break
-
-    return matching_reads
+                path = columns[5]  # Segment/path information, e.g. >12<34>56
+                # Whole node IDs only, so segment 12 does not match a path through node 1234
+                for node in path.replace("<", ">").split(">"):
+                    for region in node_to_regions.get(node, ()):
+                        region_reads[region].add(columns[0])  # Read name
 
-def process_region(region, segment_ids, alignment_file, file_extension, result_queue):
-    """Processes each region individually and stores results in a queue."""
-    if file_extension == ".gam":
-        reads = extract_reads_from_gam(alignment_file, segment_ids)
-    elif file_extension == ".gaf":
-        reads = extract_reads_from_gaf(alignment_file, segment_ids)
-    else:
-        raise ValueError("Unsupported file format. Please provide a GAM or GAF file.")
-
-    result_queue.put((region, reads))
+    return region_reads
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Find reads mapped to nodes from a JSON file in a GAM or GAF file.")
@@ -80,21 +78,16 @@ if __name__ == "__main__":
     nodes_dict = extract_nodes(args.json_file)
     print(f"Extracted {len(nodes_dict)} regions from {args.json_file}")
 
-    # Initialize thread queue
-    result_queue = queue.Queue()
-    threads = []
-
-    for region, segment_ids in nodes_dict.items():
-        thread = threading.Thread(target=process_region, args=(region, segment_ids, args.alignment_file, file_extension, result_queue))
-        thread.start()
-        threads.append(thread)
-
-    for thread in threads:
-        thread.join()
+    # One pass over the alignments serves every region; each read is routed to the regions of the nodes it maps to
+    if file_extension == ".gam":
+        region_reads = extract_reads_from_gam(args.alignment_file, nodes_dict)
+    elif file_extension == ".gaf":
+        region_reads = extract_reads_from_gaf(args.alignment_file, nodes_dict)
+    else:
+        raise ValueError("Unsupported file format. Please provide a GAM or GAF file.")
 
     # Print results
-    while not result_queue.empty():
-        region, reads = result_queue.get()
+    for region, reads in region_reads.items():
         print(f"\nRegion: {region}")
         if reads:
             print(f"  Reads mapped ({len(reads)} total):")
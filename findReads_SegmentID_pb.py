@@ -1,19 +1,23 @@
-import json
+import orjson
 import argparse
-import threading
-import queue
+import multiprocessing
+from array import array
+import numpy as np
+from itertools import islice
+import stream  # pystream-protobuf
+from google.protobuf.message import DecodeError
 import vg_pb2  # Import VG's Protobuf schema
 
 def load_json(json_file):
     """Loads the JSON file and maps segment IDs to regions."""
-    with open(json_file, "r") as f:
-        data = json.load(f)
+    with open(json_file, "rb") as f:
+        data = orjson.loads(f.read())
 
     segment_to_region = {}  # Map segment_id to region
     for region, details in data.items():
         if "segments" in details:
             for segment in details["segments"]:
-                segment_id = str(segment["segment_id"])  # Convert to string for lookup
+                segment_id = int(segment["segment_id"])  # Integer keys match Alignment node_ids without str() conversion
                 segment_to_region[segment_id] = region
 
         # Initialize read storage for each region
@@ -22,102 +26,158 @@ def load_json(json_file):
 
     return data, segment_to_region
 
-def process_gam_worker(read_queue, segment_to_region, json_data, lock, processed_count):
-    """Worker thread to process reads from the queue."""
-    while True:
+# Sorted segment IDs, their regions in the same order, and a bitmap prefilter, set once per worker process by init_worker
+_SEGMENT_IDS = np.empty(0, dtype=np.int64)
+_SEGMENT_REGIONS = []
+_SEGMENT_FILTER = np.zeros(1 << 21, dtype=np.uint8)  # 2^24-bit prefilter (2 MiB)
+
+def filter_bits(node_ids):
+    """Hash node IDs to 24-bit positions in the prefilter bitmap (multiplicative hashing)."""
+    return (node_ids.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(0xFFFFFF)
+
+def init_worker(segment_to_region):
+    """Store the segment IDs sorted for np.searchsorted, with their regions in the same order, in each worker."""
+    global _SEGMENT_IDS, _SEGMENT_REGIONS, _SEGMENT_FILTER
+    _SEGMENT_IDS = np.array(sorted(segment_to_region), dtype=np.int64)
+    _SEGMENT_REGIONS = [segment_to_region[segment_id] for segment_id in _SEGMENT_IDS.tolist()]
+    bits = filter_bits(_SEGMENT_IDS)
+    _SEGMENT_FILTER = np.zeros(1 << 21, dtype=np.uint8)
+    np.bitwise_or.at(_SEGMENT_FILTER, bits >> np.uint64(3), np.left_shift(1, bits & np.uint64(7)).astype(np.uint8))
+
+def parse_reads(messages):
+    """Parse serialized reads into Alignments, skipping corrupted ones."""
+    reads = []
+    for message_data in messages:
+        read = vg_pb2.Alignment()
         try:
-            read = read_queue.get(timeout=3)  # Get a read from the queue
-        except queue.Empty:
-            break
-
-        processed = False
-        for mapping in read.path.mapping:
-            segment_id = str(mapping.position.node_id)
-
-            if segment_id in segment_to_region:
-                region = segment_to_region[segment_id]
-
-                # Construct read details
-                read_info = {
-                    "read_name": read.name,
-                    "sequence_length": len(read.sequence),
-                    "mapping_position": mapping.position.offset
-                }
-
-                # Lock required for safe multi-threaded dictionary updates
-                with lock:
-                    json_data[region]["aligned_reads"].append(read_info)
-                processed = True
-                break  # Avoid duplicate reads in the same region
-
-        # Update and print progress every 1000 reads
-        if processed:
-            with lock:
-                processed_count[0] += 1
-                if processed_count[0] % 1000 == 0:
-                    print(f"Processed {processed_count[0]} reads...")
-
-        read_queue.task_done()
-
-def iterate_gam_binary(gam_file, read_queue):
-    """Reads a GAM file in binary format and adds reads to a queue."""
-    with open(gam_file, "rb") as f:
-        while True:
-            try:
-                read = vg_pb2.Alignment()
-
-                # Read the size of the next message (4 bytes)
-                size_bytes = f.read(4)
-                if not size_bytes:
-                    break  # End of file
-
-                # Convert the 4-byte size header to an integer
-                size = int.from_bytes(size_bytes, "little")
-
-                # Read the exact number of bytes expected for the message
-                message_data = f.read(size)
-                if len(message_data) != size:
-                    print(f"⚠️ Skipping corrupted read (expected {size} bytes, got {len(message_data)})")
-                    continue  # Skip to the next read
-
-                # Parse the protobuf message
-                read.ParseFromString(message_data)
-                read_queue.put(read)  # Add valid read to the queue
-
-            except Exception as e:
-                print(f"⚠️ Skipping a corrupted read: {e}")
-                continue  # Skip the problematic read and move to the next one
-
-
-def process_gam_file(gam_file, segment_to_region, json_data, num_threads):
-    """Distributes binary GAM parsing across multiple threads."""
-    read_queue = queue.Queue()
-    lock = threading.Lock()
-    processed_count = [0]  # Shared counter for processed reads
-
-    # Start a thread to read the GAM file
-    reader_thread = threading.Thread(target=iterate_gam_binary, args=(gam_file, read_queue))
-    reader_thread.start()
-
-    # Start worker threads
-    threads = []
-    for _ in range(num_threads):
-        thread = threading.Thread(target=process_gam_worker, args=(read_queue, segment_to_region, json_data, lock, processed_count))
-        thread.start()
-        threads.append(thread)
-
-    # Wait for all threads to finish
-    reader_thread.join()
-    read_queue.join()
-    for thread in threads:
-        thread.join()
-
-if __name__ == "__main__":
+            read.ParseFromString(message_data)
+        except DecodeError as e:
+            print(f"⚠️ Skipping a corrupted read: {e}")
+            continue
+        reads.append(read)
+    return reads
+
+def process_batch(messages):
+    """Parse a batch of serialized reads in a worker process.
+
+    Returns the assigned reads as parallel columns: (regions, read_names, sequence_lengths, mapping_positions).
+    """
+    regions, read_names, sequence_lengths, mapping_positions = [], [], [], []
+    reads = parse_reads(messages)
+    if not reads or not len(_SEGMENT_IDS):
+        return regions, read_names, sequence_lengths, mapping_positions
+
+    # Flatten every mapping's node ID in the batch; offsets[i] is where read i's mappings start
+    counts = np.fromiter((len(read.path.mapping) for read in reads), dtype=np.int64, count=len(reads))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    node_ids = np.fromiter(
+        (mapping.position.node_id for read in reads for mapping in read.path.mapping), dtype=np.int64, count=offsets[-1]
+    )
+
+    # Segments are sparse in the graph, so the bitmap rejects most node IDs before any binary search
+    bits = filter_bits(node_ids)
+    candidates = np.flatnonzero((_SEGMENT_FILTER[bits >> np.uint64(3)] >> (bits & np.uint64(7)).astype(np.uint8)) & 1)
+
+    # One binary search over the sorted segment IDs confirms the remaining candidates
+    candidate_ids = node_ids[candidates]
+    idx = np.searchsorted(_SEGMENT_IDS, candidate_ids).clip(max=len(_SEGMENT_IDS) - 1)
+    matched = _SEGMENT_IDS[idx] == candidate_ids
+    hits = candidates[matched]
+    hit_segments = idx[matched]
+
+    # The first hit of each read wins, which avoids duplicate reads in the same region
+    hit_reads = np.searchsorted(offsets, hits, side="right") - 1
+    read_indices, first = np.unique(hit_reads, return_index=True)
+
+    for read_index, hit, segment in zip(read_indices.tolist(), hits[first].tolist(), hit_segments[first].tolist()):
+        read = reads[read_index]
+        regions.append(_SEGMENT_REGIONS[segment])
+        read_names.append(read.name)
+        sequence_lengths.append(len(read.sequence))
+        mapping_positions.append(read.path.mapping[hit - offsets[read_index]].position.offset)
+    return regions, read_names, sequence_lengths, mapping_positions
+
+# vg starts every group of a GAM with this type tag message; it is not an Alignment
+GAM_TYPE_TAG = b"GAM"
+
+def iterate_gam_binary(gam_file):
+    """Reads a GAM file (BGZF-compressed groups of varint-delimited Alignments) and yields the serialized reads."""
+    # Tags are skipped here rather than with stream.open(header=...), which rejects groups holding more than one read
+    with stream.open(gam_file, "rb") as gam:
+        for message in gam:
+            if message != GAM_TYPE_TAG:
+                yield message  # Parsed in the worker processes
+
+def iter_batches(messages, batch_size):
+    """Group an iterable of messages into lists of at most batch_size messages."""
+    messages = iter(messages)
+    while True:
+        batch = list(islice(messages, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def process_gam_file(gam_file, segment_to_region, num_workers, batch_size=1000):
+    """Streams the binary GAM through worker processes and returns the assigned reads as {region: columns}."""
+    print("Started processing GAM file...")
+
+    processed_count = 0
+    # Assigned reads per region as parallel columns (names, int32 lengths, int64 offsets) rather than one dict per read
+    region_columns = {}
+    # Workers parse and match off the GIL; only the main process collects the results, so no lock is needed
+    with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(segment_to_region,)) as pool:
+        batches = iter_batches(iterate_gam_binary(gam_file), batch_size)
+        for regions, read_names, sequence_lengths, mapping_positions in pool.imap_unordered(process_batch, batches):
+            for region, read_name, sequence_length, mapping_position in zip(
+                regions, read_names, sequence_lengths, mapping_positions
+            ):
+                columns = region_columns.get(region)
+                if columns is None:
+                    columns = region_columns[region] = ([], array("i"), array("q"))
+                columns[0].append(read_name)
+                columns[1].append(sequence_length)
+                columns[2].append(mapping_position)
+
+            # Print progress every 1000 assigned reads
+            processed_count += len(regions)
+            if regions and processed_count % 1000 < len(regions):
+                print(f"Processed {processed_count} reads...")
+
+    return region_columns
+
+def save_json(json_data, region_columns, output_json):
+    """Write json_data with the assigned reads added, one region at a time, in the same layout as an indented dump.
+
+    Each region's columns are expanded into read dicts only while that region is written and are dropped right
+    after, so at most one region's dicts exist at once.
+    """
+    with open(output_json, "wb") as f:
+        f.write(b"{")
+        for i, (region, details) in enumerate(json_data.items()):
+            f.write(b",\n  " if i else b"\n  ")
+            f.write(orjson.dumps(region))
+            f.write(b": ")
+
+            columns = region_columns.pop(region, None)
+            if columns is not None:
+                read_names, sequence_lengths, mapping_positions = columns
+                details = dict(details, aligned_reads=details["aligned_reads"] + [
+                    {"read_name": read_name, "sequence_length": sequence_length, "mapping_position": mapping_position}
+                    for read_name, sequence_length, mapping_position in zip(read_names, sequence_lengths, mapping_positions)
+                ])
+                del columns, read_names, sequence_lengths, mapping_positions
+
+            # Nest the region's own indented dump one level deeper (JSON strings never contain raw newlines)
+            f.write(orjson.dumps(details, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  "))
+            del details
+        f.write(b"\n}" if json_data else b"}")
+
+def main():
     parser = argparse.ArgumentParser(description="Find reads mapped to segments from a JSON file and update the JSON with aligned reads.")
     parser.add_argument("json_file", type=str, help="Input JSON file containing segment IDs.")
     parser.add_argument("gam_file", type=str, help="Input GAM file (binary).")
     parser.add_argument("output_json", type=str, help="Output JSON file with updated aligned reads.")
-    parser.add_argument("--threads", type=int, default=4, help="Number of threads to use (default: 4)")
+    parser.add_argument("-t", "--threads", type=int, default=4, help="Number of worker processes to use (default: 4)")
 
     args = parser.parse_args()
 
@@ -126,10 +186,12 @@ if __name__ == "__main__":
     print(f"Loaded {len(segment_to_region)} segment IDs from {args.json_file}")
 
     # Process the GAM file with user-defined thread count
-    process_gam_file(args.gam_file, segment_to_region, json_data, args.threads)
+    region_columns = process_gam_file(args.gam_file, segment_to_region, args.threads)
 
     # Save to new JSON file
-    with open(args.output_json, "w") as f:
-        json.dump(json_data, f, indent=4)
+    save_json(json_data, region_columns, args.output_json)
 
     print(f"\nUpdated JSON saved to {args.output_json}")
+
+if __name__ == "__main__":
+    main()
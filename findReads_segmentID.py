@@ -4,26 +4,26 @@ import argparse
 
 
 def extract_reads(gam_file, segment_ids):
-    # Run vg view to convert the GAM file to JSON
-    result = subprocess.run(['vg', 'view', '-a', gam_file], stdout=subprocess.PIPE, text=True)
-
-    if result.returncode != 0:
-        print(f"Error running vg view on {gam_file}")
-        return
+    # Run vg view to convert the GAM file to JSON, streamed as bytes through a 1 MiB pipe buffer
+    process = subprocess.Popen(['vg', 'view', '-a', gam_file], stdout=subprocess.PIPE, bufsize=1 << 20)
 
     matching_reads = []
 
-    # Process each read in the GAM file
-    for line in result.stdout.strip().split('\n'):
+    # Process each read in the GAM file as it arrives
+    for line in process.stdout:
         read = json.loads(line)
 
         # Check if any of the path segments match the provided segment IDs
-        if 'path' in read:
-            for mapping in read['path']['mapping']:
-                if 'position' in mapping and 'node_id' in mapping['position']:
-                    if str(mapping['position']['node_id']) in segment_ids:
-                        matching_reads.append(read['name'])
-                        break
+        for mapping in read.get('path', {}).get('mapping', ()):
+            node_id = mapping.get('position', {}).get('node_id')
+            if node_id is not None and str(node_id) in segment_ids:
+                matching_reads.append(read['name'])
+                break
+
+    process.stdout.close()
+    if process.wait() != 0:
+        print(f"Error running vg view on {gam_file}")
+        return
 
     return matching_reads
 
@@ -1,48 +1,104 @@
 import subprocess
+import shutil
+import tempfile
+import contextlib
 import json
+import orjson
 import sys
 import argparse
 
 
+# Absolute vg path: with it and close_fds=False, subprocess spawns vg with posix_spawn instead of fork+exec
+VG = shutil.which("vg") or "vg"
+
+
+def run_vg_find(find_args):
+    """Run `vg find <find_args> | vg view -j -` as two chained processes, no shell; return (data, None) or (None, stderr)."""
+    with tempfile.TemporaryFile() as find_stderr:
+        find = subprocess.Popen([VG, "find", *find_args], stdout=subprocess.PIPE, stderr=find_stderr, close_fds=False)
+        view = subprocess.Popen([VG, "view", "-j", "-"], stdin=find.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                close_fds=False)
+        find.stdout.close()  # vg view owns the pipe now, so vg find gets SIGPIPE if vg view exits early
+        output, view_stderr = view.communicate()
+        find.wait()
+
+        if find.returncode != 0 or view.returncode != 0:
+            find_stderr.seek(0)
+            return None, find_stderr.read().decode() + view_stderr.decode()
+    return orjson.loads(output), None
+
+
 def run_vg_find_position(position, graph_path):
     """Find the node corresponding to a given position."""
     # cmd = f'/home/jiawei/anaconda3/envs/pange/bin/vg find -x ./Pangenome_Graph/hprc-v1.1-mc-grch38.d9.gbz -p {position} | vg view -j -'
-    cmd = f'vg find -x {graph_path} -p {position} | vg view -j -'
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
-        print("Error running vg find for position:", result.stderr)
+    data, error = run_vg_find(["-x", graph_path, "-p", position])
+    if error is not None:
+        print("Error running vg find for position:", error)
         return None
-    return json.loads(result.stdout)
+    return data
 
 
 def run_vg_find_neighbors(node_id, graph_path, context=5):
     """Find neighboring nodes within the given context range."""
     # cmd = f'/home/jiawei/anaconda3/envs/pange/bin/vg find -x {graph_path} -n {node_id} -c {context} | /home/jiawei/anaconda3/envs/pange/bin/vg view -j -'
-    cmd = f'vg find -x {graph_path} -n {node_id} -c {context} | vg view -j -'
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
-        print("Error running vg find for neighbors:", result.stderr)
+    data, error = run_vg_find(["-x", graph_path, "-n", str(node_id), "-c", str(context)])
+    if error is not None:
+        print("Error running vg find for neighbors:", error)
         return None
-    return json.loads(result.stdout)
-
+    return data
 
-def main():
-    parser = argparse.ArgumentParser(description="Find segments in a graph based on a given position.")
-    parser.add_argument('position', type=str, help='Position to search in the graph')
-    parser.add_argument('graph_path', default="./Pangenome_Graph/hprc-v1.1-mc-grch38.d9.gbz", type=str, help='Path to the graph file')
-    args = parser.parse_args()
 
-    position_data = run_vg_find_position(args.position, args.graph_path)
+def process(position, graph_path, context=5):
+    """Find the node at a position and return its neighborhood as vg JSON, or None if either lookup fails."""
+    position_data = run_vg_find_position(position, graph_path)
     if not position_data or "node" not in position_data:
         print("No node found for given position.")
-        sys.exit(1)
+        return None
 
     node_id = position_data["node"][0]["id"]
     print(f"Found node ID: {node_id}")
 
-    neighbors_data = run_vg_find_neighbors(node_id, args.graph_path)
+    neighbors_data = run_vg_find_neighbors(node_id, graph_path, context)
     if not neighbors_data:
         print("No neighboring nodes found.")
+        return None
+    return neighbors_data
+
+
+def process_batch(positions_file, graph_path):
+    """Run process() for each position in a file ('-' for stdin) and write one JSON line per position, null on failure."""
+    with contextlib.ExitStack() as stack:
+        positions = sys.stdin if positions_file == "-" else stack.enter_context(open(positions_file))
+        for line in positions:
+            position = line.strip()
+            if not position:
+                continue
+            # Progress and error messages go to stderr so stdout stays one result per line
+            with contextlib.redirect_stdout(sys.stderr):
+                try:
+                    neighbors_data = process(position, graph_path)
+                except Exception as e:
+                    # One bad position (e.g. vg exiting 0 with no output) must not end the whole batch
+                    print(f"Error processing position {position}: {e}")
+                    neighbors_data = None
+            sys.stdout.buffer.write(orjson.dumps(neighbors_data) + b"\n")
+            if positions is sys.stdin:
+                sys.stdout.buffer.flush()  # Answer each request as it arrives when driven over a pipe
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find segments in a graph based on a given position.")
+    parser.add_argument('position', type=str, help='Position to search in the graph (with --batch, a file of positions, one per line, or - for stdin)')
+    parser.add_argument('graph_path', default="./Pangenome_Graph/hprc-v1.1-mc-grch38.d9.gbz", type=str, help='Path to the graph file')
+    parser.add_argument('--batch', action='store_true', help='Look up every position in the file and print one JSON result per line (with -, each line is answered as it arrives)')
+    args = parser.parse_args()
+
+    if args.batch:
+        process_batch(args.position, args.graph_path)
+        return
+
+    neighbors_data = process(args.position, args.graph_path)
+    if neighbors_data is None:
         sys.exit(1)
 
     print(json.dumps(neighbors_data, indent=4))
@@ -1,99 +1,426 @@
-import json
+import contextlib
+import hashlib
+import io
+import ijson
+import multiprocessing
+import orjson
+import os
+import queue
+import shutil
+import sqlite3
 import subprocess
 import argparse
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 
+# Cached segments are only reused while this script's source is unchanged
+with open(__file__, 'rb') as _source:
+    SOURCE_SIGNATURE = hashlib.sha1(_source.read()).hexdigest()
+
+# Absolute vg path: with it and close_fds=False, subprocess spawns vg with posix_spawn instead of fork+exec
+VG = shutil.which("vg") or "vg"
+
+# Graph formats libbdsg can load in-process; GBZ and XG still go through vg find
+BDSG_GRAPH_TYPES = {".pg": "PackedGraph", ".hg": "HashGraph", ".og": "ODGI"}
+
+
+@lru_cache(maxsize=None)
+def load_bdsg_graph(graph_file):
+    """Load the graph once with libbdsg and index its path positions; return None for formats it cannot read."""
+    graph_type = BDSG_GRAPH_TYPES.get(os.path.splitext(graph_file)[1])
+    if graph_type is None:
+        return None
+
+    import bdsg
+    graph = getattr(bdsg.bdsg, graph_type)()
+    graph.deserialize(graph_file)
+    return graph, bdsg.bdsg.PackedPositionOverlay(graph)  # Keep the base graph referenced alongside its overlay
+
+
+def init_worker(gbz_file, worker_counter, cache_file=None):
+    """Open the segment cache and load the in-process graph in a pool worker; if the graph loaded, pin the worker to a CPU."""
+    open_segments_cache(cache_file)
+
+    # vg find/vg view children inherit the affinity, so workers that shell out to vg stay unpinned
+    if load_bdsg_graph(gbz_file) is None or not hasattr(os, "sched_setaffinity"):
+        return
+
+    with worker_counter.get_lock():
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+    cpus = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+
+
+def extract_segments_bdsg(graph, path_range):
+    """Collect the nodes in a path range and the paths through them, as extract_segments_from_json does with vg."""
+    path_name, _, span = path_range.rpartition(":")
+    start, _, end = span.rpartition("-")  # Split on the last '-': windows near the path start have a negative start
+    start, end = max(int(start), 0), int(end)
+    if not graph.has_path(path_name):
+        return []
+
+    path = graph.get_path_handle(path_name)
+    if start >= graph.get_path_length(path):
+        return []  # Past the end the overlay would hand back path_end(), which is not a real step
+    segment_info = {}
+    step = graph.get_step_at_position(path, start)
+    while graph.get_position_of_step(step) <= end:
+        handle = graph.get_handle_of_step(step)
+        node_id = str(graph.get_id(handle))  # String IDs, as vg find reports them
+        if node_id not in segment_info:
+            paths = []
+
+            def visit(node_step):
+                name = graph.get_path_name(graph.get_path_handle_of_step(node_step))
+                if name not in paths:
+                    paths.append(name)
+                return True
+
+            graph.for_each_step_on_handle(handle, visit)
+            segment_info[node_id] = {'segment_id': node_id, 'paths': paths}
+
+        if not graph.has_next_step(step):
+            break
+        step = graph.get_next_step(step)
+
+    return list(segment_info.values())
+
+
+# Connection to the optional on-disk segment cache, opened once per worker process by open_segments_cache
+_SEGMENTS_CACHE = None
+
+
+def open_segments_cache(cache_file):
+    """Open (creating if needed) the SQLite file that caches segment lookups across runs; None leaves caching off."""
+    global _SEGMENTS_CACHE
+    if cache_file is None:
+        _SEGMENTS_CACHE = None
+        return
+    # One file for every cached range; the busy timeout lets pool workers take turns writing to it
+    _SEGMENTS_CACHE = sqlite3.connect(cache_file, timeout=60, isolation_level=None)
+    _SEGMENTS_CACHE.execute("CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, segments BLOB NOT NULL)")
+
+
+def segments_cache_key(gbz_file, path_range):
+    """Cache key for a (graph, path range) pair; the graph's mtime and size and this script's source invalidate stale entries."""
+    try:
+        stat = os.stat(gbz_file)
+    except OSError:
+        return None
+    return hashlib.sha1(
+        f"{SOURCE_SIGNATURE}:{os.path.abspath(gbz_file)}:{stat.st_mtime}:{stat.st_size}:{path_range}".encode()
+    ).hexdigest()
+
+
+# Variant lists often repeat positions; each worker answers a repeated path range from memory (segments are never mutated)
+@lru_cache(maxsize=4096)
 def extract_segments_from_json(gbz_file, path_range):
-    # Run vg find and pipe to vg view to get JSON output
-    cmd = f"vg find -x {gbz_file} -p {path_range} | vg view -v -j -"
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Results from earlier runs on the same graph are read back from the cache file, when one is in use
+    cache_key = segments_cache_key(gbz_file, path_range) if _SEGMENTS_CACHE is not None else None
+    if cache_key is not None:
+        row = _SEGMENTS_CACHE.execute("SELECT segments FROM segments WHERE key = ?", (cache_key,)).fetchone()
+        if row is not None:
+            return orjson.loads(row[0])
+
+    # Graphs libbdsg can read are loaded once and queried in-process, no vg find per position
+    bdsg_graph = load_bdsg_graph(gbz_file)
+    if bdsg_graph is not None:
+        segments = extract_segments_bdsg(bdsg_graph[1], path_range)
+    else:
+        segments = extract_segments_vg(gbz_file, path_range)  # Raises on failure, so neither cache keeps it
+
+    if cache_key is not None:
+        _SEGMENTS_CACHE.execute("INSERT OR REPLACE INTO segments VALUES (?, ?)", (cache_key, orjson.dumps(segments)))
+    return segments
+
+
+def extract_segments_vg(gbz_file, path_range):
+    """Collect the nodes in a path range and the paths through them with vg find; raise RuntimeError if vg fails."""
+    # Run vg find and pipe it straight into vg view to get JSON output, no shell in between
+    find = subprocess.Popen([VG, "find", "-x", gbz_file, "-p", path_range], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, close_fds=False)
+    process = subprocess.Popen([VG, "view", "-v", "-j", "-"], stdin=find.stdout, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, bufsize=1 << 20, close_fds=False)
+    find.stdout.close()  # vg view owns the pipe now, so vg find gets SIGPIPE if vg view exits early
 
     segment_info = {}
 
     for line in process.stdout:
-        data = json.loads(line)
+        data = orjson.loads(line)  # Parses the raw bytes lines directly
 
         # Extract node (segment) IDs
         if 'node' in data:
+            # Index the paths through each node in one pass over the mappings (dict keys keep path order)
+            node_to_paths = {}
+            for path in data.get('path', ()):
+                for mapping in path['mapping']:
+                    node_to_paths.setdefault(mapping['position']['node_id'], {})[path['name']] = None
+
             for node in data['node']:
                 node_id = node['id']
 
                 # Check if this node is part of a path
-                if 'path' in data:
-                    for path in data['path']:
-                        for mapping in path['mapping']:
-                            if mapping['position']['node_id'] == node_id:
-                                if node_id not in segment_info:
-                                    segment_info[node_id] = {'segment_id': node_id, 'paths': []}
-                                if path['name'] not in segment_info[node_id]['paths']:
-                                    segment_info[node_id]['paths'].append(path['name'])
+                path_names = node_to_paths.get(node_id)
+                if path_names is not None:
+                    segment = segment_info.get(node_id)
+                    if segment is None:
+                        segment = segment_info[node_id] = {'segment_id': node_id, 'paths': []}
+                    for path_name in path_names:
+                        if path_name not in segment['paths']:
+                            segment['paths'].append(path_name)
 
     process.stdout.close()
-    process.wait()
+    if process.wait() != 0 or find.wait() != 0:
+        raise RuntimeError(f"vg find/vg view failed for {path_range}")
 
     return list(segment_info.values())
 
 
-def call_find_segments(gbz_file, chromosome, position, record, windowLength=100, ref="GRCh38#0"):
+def call_find_segments(gbz_file, chromosome, position, record, windowLength=100, ref="GRCh38#0", verbose=False):
     """Call extract_segments_from_json with the given chromosome and position."""
     formatted_position = f"{ref}#{chromosome}:{position - windowLength}-{position + windowLength}"
     segments = extract_segments_from_json(gbz_file, formatted_position)
-    print(f"Output for {formatted_position}: {segments}")
+    if verbose:
+        print(f"Output for {formatted_position}: {segments}")
     return {formatted_position: {"segments": segments, "variants": record}}
 
 
-def process_record(gbz_file, record):
-    chromosome = record.get('chromosome')
-    position = record.get('position')
+# Both fields in one C-level call per record instead of two .get method lookups and calls
+_record_fields = itemgetter('chromosome', 'position')
 
-    if not chromosome or not position:
-        return None, f"Skipping record due to missing chromosome or position: {record}"
 
-    print(f"Processing {chromosome}:{position}")
-    segment_data = call_find_segments(gbz_file, chromosome, position, record)
+def record_fields(record):
+    """Return (chromosome, position) for a record with a non-empty chromosome name and a non-zero numeric position, else None."""
+    try:
+        chromosome, position = _record_fields(record)
+    except (KeyError, TypeError):
+        return None
+    if isinstance(chromosome, str) and chromosome and isinstance(position, (int, float)) and position:
+        return chromosome, position
+    return None
+
+
+def process_record(gbz_file, fields, record, verbose=False):
+    """Look up the segments around one record whose (chromosome, position) fields were validated by record_fields."""
+    chromosome, position = fields
+    if verbose:
+        print(f"Processing {chromosome}:{position}")
+    segment_data = call_find_segments(gbz_file, chromosome, position, record, verbose=verbose)
     return segment_data, None
 
 
-def main(json_file, gbz_file, threads, output_file):
-    # Load JSON data
+def process_records(gbz_file, records, verbose=False):
+    """Process a batch of (fields, record) pairs in a worker process; return (segment_data, error) for each record."""
+    outcomes = []
+    # Per-record progress is collected and written once per batch, one write instead of one per print
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        for fields, record in records:
+            try:
+                outcomes.append(process_record(gbz_file, fields, record, verbose))
+            except Exception as e:
+                outcomes.append((None, f"Error processing record {record}: {e}"))
+    sys.stdout.write(log.getvalue())
+    sys.stdout.flush()
+    return outcomes
+
+
+def save_results(results, output_file):
+    """Write results with orjson to a temp file and rename it, so an interrupted save never truncates the output."""
+    temp_file = output_file + ".tmp"
+    with open(temp_file, 'wb') as outfile:
+        outfile.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    os.replace(temp_file, output_file)
+
+
+def results_writer(write_queue, output_file):
+    """Save queued (results, processed) snapshots in the background until a None sentinel arrives."""
+    stop = False
+    while not stop:
+        snapshot = write_queue.get()
+        # Skip snapshots that a newer one already supersedes
+        while not write_queue.empty():
+            newer = write_queue.get()
+            if newer is None:
+                stop = True
+            else:
+                snapshot = newer
+        if snapshot is None:
+            return
+
+        results, processed = snapshot
+        try:
+            save_results(results, output_file)
+            print(f"Intermediate results saved to {output_file} after {processed} records.")
+        except Exception as e:
+            print(f"Error saving intermediate results: {e}")
+
+
+def iter_parquet_records(records_file):
+    """Stream rows of a Parquet file as record dicts, one row group at a time."""
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(records_file).iter_batches():
+        yield from batch.to_pylist()
+
+
+def iter_msgpack_records(records_file):
+    """Stream the records of a top-level msgpack array one at a time."""
+    import msgpack
+
+    with open(records_file, 'rb') as file:
+        unpacker = msgpack.Unpacker(file, raw=False)
+        try:
+            for _ in range(unpacker.read_array_header()):
+                yield unpacker.unpack()
+        except msgpack.OutOfData:
+            raise ValueError(f"Truncated msgpack record file: {records_file}")
+
+
+def check_json_records(json_file):
+    """Scan a JSON record file once with ijson and exit on the first syntax error, before any record is dispatched."""
     try:
-        with open(json_file, 'r') as file:
-            data = json.load(file)
-    except Exception as e:
+        with open(json_file, 'rb') as file:
+            events = ijson.basic_parse(file)
+            first = next(events, (None, None))[0]
+            if first != 'start_array':
+                raise ValueError("expected a top-level JSON array of records")
+            for _ in events:
+                pass
+    except (OSError, ValueError, ijson.JSONError) as e:
+        print(f"Error reading JSON file: {e}")
+        sys.exit(1)
+
+
+def iter_records(json_file):
+    """Stream the records of a top-level JSON array one at a time with ijson (or a Parquet or msgpack record file)."""
+    try:
+        # Binary formats skip JSON tokenization entirely when the same record list is processed repeatedly
+        if json_file.endswith(".parquet"):
+            yield from iter_parquet_records(json_file)
+        elif json_file.endswith((".msgpack", ".mp")):
+            yield from iter_msgpack_records(json_file)
+        else:
+            with open(json_file, 'rb') as file:
+                yield from ijson.items(file, 'item', use_float=True)  # Plain floats, so records serialize with orjson
+    except (OSError, ValueError, ijson.JSONError) as e:
         print(f"Error reading JSON file: {e}")
         sys.exit(1)
 
+
+def iter_sorted_windows(records, window_size, skipped):
+    """Yield ((chromosome, position), record) pairs sorted by those fields within windows of window_size records.
+
+    Malformed records are dropped and counted in skipped[0].
+    """
+    records = iter(records)
+    while True:
+        window = list(islice(records, window_size))
+        if not window:
+            return
+        # Each record is unpacked and checked exactly once; workers receive the validated fields with it
+        valid = [(fields, record) for record in window if (fields := record_fields(record)) is not None]
+        skipped[0] += len(window) - len(valid)
+        valid.sort(key=itemgetter(0))
+        yield from valid
+
+
+def iter_batches(records, batch_size):
+    """Group an iterable of records into lists of at most batch_size records."""
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def main(json_file, gbz_file, threads, output_file, records_per_task=20, sort_window=10000, verbose=False,
+         cache_file=None):
+    # A malformed JSON file is rejected up front rather than after part of it has been processed
+    if not json_file.endswith((".parquet", ".msgpack", ".mp")):
+        check_json_records(json_file)
+
     results = {}
+    # A .jsonl output gets one {"position", "segments", "variants"} line per record as soon as it is merged
+    jsonl_output = output_file.endswith(".jsonl")
+    jsonl_file = None
 
-    with ThreadPoolExecutor(max_workers=threads) as executor:
-        future_to_record = {executor.submit(process_record, gbz_file, record): record for record in data}
+    # Load an in-process graph before the workers fork so they share one copy
+    load_bdsg_graph(gbz_file)
 
-        for i, future in enumerate(as_completed(future_to_record)):
-            record = future_to_record[future]
-            try:
-                segment_data, error = future.result()
+    processed = 0
+    last_saved = 0
+    skipped = [0]
+
+    # Intermediate saves run on a writer thread so merging never waits on serialization or disk
+    write_queue = queue.Queue()
+    writer = threading.Thread(target=results_writer, args=(write_queue, output_file))
+    writer.start()
+
+    def merge(done):
+        nonlocal processed, last_saved
+        for future in done:
+            for segment_data, error in future.result():
+                processed += 1
                 if error:
                     print(error)
                     continue
-                results.update(segment_data)
-            except Exception as e:
-                print(f"Error processing record {record}: {e}")
+                if not jsonl_output:
+                    results.update(segment_data)
+                    continue
+                for formatted_position, entry in segment_data.items():
+                    jsonl_file.write(orjson.dumps({"position": formatted_position, **entry}) + b"\n")
 
-            # Save results every 80 iterations
-            if (i + 1) % 80 == 0:
-                try:
-                    with open(output_file, 'w') as outfile:
-                        json.dump(results, outfile, indent=4)
-                    print(f"Intermediate results saved to {output_file} after {i + 1} records.")
-                except Exception as e:
-                    print(f"Error saving intermediate results: {e}")
+            # Save results every 80 records
+            if not jsonl_output and processed - last_saved >= 80:
+                last_saved = processed
+                write_queue.put((dict(results), processed))  # Shallow snapshot; merged entries are never mutated
+
+    try:
+        # Opened inside the try so the finally below always closes (and flushes) it
+        if jsonl_output:
+            jsonl_file = open(output_file, 'wb')
+
+        # Workers load the graph once in the initializer (a no-op lru_cache hit when forked after the load above)
+        # and each takes the next CPU, so a worker's graph pages stay in one core's caches
+        worker_counter = multiprocessing.Value('i', 0)
+        with ProcessPoolExecutor(max_workers=threads, initializer=init_worker,
+                                 initargs=(gbz_file, worker_counter, cache_file)) as executor:
+            # Records are parsed while workers run; a bounded number of batches in flight keeps memory flat
+            max_pending = 2 * (threads or os.cpu_count())
+            pending = set()
+            # Records are validated here once, and nearby positions land in the same batch, so each worker walks
+            # one region of the graph and repeats hit its cache
+            records = iter_sorted_windows(iter_records(json_file), sort_window, skipped)
+            for batch in iter_batches(records, records_per_task):
+                pending.add(executor.submit(process_records, gbz_file, batch, verbose))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    merge(done)
+            merge(wait(pending).done)
+    finally:
+        write_queue.put(None)
+        writer.join()
+        if jsonl_file is not None:
+            jsonl_file.close()
+
+    if skipped[0]:
+        print(f"Skipped {skipped[0]} records with a missing or invalid chromosome or position.")
+
+    if jsonl_output:
+        print(f"Final results saved to {output_file}.")
+        return
 
     # Save final results
     try:
-        with open(output_file, 'w') as outfile:
-            json.dump(results, outfile, indent=4)
+        save_results(results, output_file)
         print(f"Final results saved to {output_file}.")
     except Exception as e:
         print(f"Error saving final results: {e}")
@@ -102,12 +429,16 @@ def main(json_file, gbz_file, threads, output_file):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process JSON file to extract segment IDs and paths.')
     parser.add_argument('-j', '--json_file', type=str,
-                        help='Path to the JSON file containing chromosome and position data.')
-    parser.add_argument('-x', '--gbz_file', type=str, required=True, help='Path to the GBZ index or graph file.')
-    parser.add_argument('-t', '--threads', type=int, default=4,
-                        help='Number of threads to use for parallel processing.')
+                        help='Path to the JSON file containing chromosome and position data (.parquet or .msgpack record files are also read).')
+    parser.add_argument('-x', '--gbz_file', type=str, required=True, help='Path to the GBZ index or graph file (PackedGraph .pg, HashGraph .hg or ODGI .og files are queried in-process with libbdsg).')
+    parser.add_argument('-t', '--threads', type=int, default=os.cpu_count(),
+                        help='Number of worker processes to use for parallel processing (default: all CPUs).')
     parser.add_argument('-o', '--output_path', default="output_seg.json", type=str,
-                        help='Path to the output file containing segment and position data.')
+                        help='Path to the output file containing segment and position data (JSON Lines, one record per line, when it ends in .jsonl).')
+    parser.add_argument('--verbose', action='store_true', help='Print each record and its segments as it is processed')
+    parser.add_argument('--cache', dest='cache_file', type=str, default=None,
+                        help='SQLite file that caches segment lookups across runs (off by default).')
 
     args = parser.parse_args()
-    main(args.json_file, args.gbz_file, args.threads, output_file=args.output_path)
+    main(args.json_file, args.gbz_file, args.threads, output_file=args.output_path, verbose=args.verbose,
+         cache_file=args.cache_file)